@@ -1,82 +1,141 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import requests
-from bs4 import BeautifulSoup
+from lxml import etree
+from lxml import html as lxml_html
 from pathlib import Path
 from datetime import datetime
 import re
+import orjson
 import sqlite3
 import hashlib
+import hmac
+import base64
 import secrets
-from typing import Optional
+from typing import Callable, Optional
 from urllib.parse import urlparse
 import zipfile
 import io
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from collections import OrderedDict
+import codecs
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import time
+import functools
+import itertools
+import threading
+from contextlib import contextmanager
 
 # -------------------------
 # Global Session for reuse
 # -------------------------
-session = requests.Session()
-retries = Retry(total=2, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
-session.mount("https://", HTTPAdapter(max_retries=retries))
+@st.cache_resource(show_spinner=False)
+def get_http_session() -> requests.Session:
+    """One pooled client for the whole process, so keep-alive connections survive reruns"""
+    http = requests.Session()
+    retries = Retry(total=2, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+    # Pool sized for the concurrent URL fetches and per-model LLM calls
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retries)
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    return http
+
+
+session = get_http_session()
 
 # -------------------------
 # Auth (persistent via SQLite)
 # -------------------------
 DB_PATH = Path(__file__).with_name("auth.db")
 
+# Module-level SQL text so every call hits sqlite3's per-connection statement cache
+SQL_INSERT_USER = "INSERT INTO users (username, password_hash) VALUES (?, ?) ON CONFLICT(username) DO NOTHING"
+SQL_PASSWORD_HASH = "SELECT password_hash FROM users WHERE username=?"
+
 
+@st.cache_resource
 def get_db():
-    return sqlite3.connect(DB_PATH)
-
-
-def init_db():
-    with get_db() as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                username TEXT PRIMARY KEY,
-                password_hash TEXT NOT NULL
-            );
-            """
-        )
-        conn.commit()
+    """One connection shared by every session; autocommit so writes manage their own transactions"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=128)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-8000")  # 8 MB page cache
+    # Runs once per process, not on every rerun
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password_hash TEXT NOT NULL
+        );
+        """
+    )
+    return conn
+
+
+@st.cache_resource
+def get_db_lock() -> threading.Lock:
+    # Sessions run on separate threads; the shared connection is used under this lock
+    return threading.Lock()
+
+
+@contextmanager
+def db_write():
+    """Run a BEGIN IMMEDIATE ... COMMIT block on the shared connection"""
+    with get_db_lock():
+        conn = get_db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
 
 
-def hash_password(password: str, salt: Optional[str] = None) -> str:
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2**14, 8, 1
+
+
+def hash_password(password: str, salt: Optional[bytes] = None) -> str:
     if salt is None:
-        salt = secrets.token_hex(16)
-    digest = hashlib.sha256((salt + password).encode("utf-8")).hexdigest()
-    return f"{salt}${digest}"
+        salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=32)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${base64.b64encode(salt).decode()}${base64.b64encode(digest).decode()}"
 
 
 def verify_password(stored: str, provided_password: str) -> bool:
+    parts = stored.split("$")
+    password = provided_password.encode("utf-8")
     try:
-        salt, digest = stored.split("$", 1)
+        if parts[0] == "scrypt" and len(parts) == 6:
+            n, r, p = (int(v) for v in parts[1:4])
+            expected = base64.b64decode(parts[5])
+            computed = hashlib.scrypt(password, salt=base64.b64decode(parts[4]), n=n, r=r, p=p, dklen=len(expected))
+            return hmac.compare_digest(computed, expected)
+        if len(parts) == 3:
+            # Older PBKDF2 rows: salt$iterations$digest
+            salt, iterations, digest = parts
+            computed = hashlib.pbkdf2_hmac("sha256", password, bytes.fromhex(salt), int(iterations)).hex()
+            return hmac.compare_digest(computed, digest)
+        if len(parts) == 2:
+            # Rows written before PBKDF2: single-round sha256(salt + password)
+            salt, digest = parts
+            computed = hashlib.sha256((salt + provided_password).encode("utf-8")).hexdigest()
+            return hmac.compare_digest(computed, digest)
     except ValueError:
-        return False
-    return hash_password(provided_password, salt) == stored
+        pass
+    return False
 
 
 def sign_up(username: str, password: str) -> bool:
     if not username or not password:
         return False
     try:
-        with get_db() as conn:
-            cur = conn.cursor()
-            cur.execute("SELECT 1 FROM users WHERE username=?", (username,))
-            if cur.fetchone():
-                return False
-            cur.execute(
-                "INSERT INTO users (username, password_hash) VALUES (?, ?)",
-                (username, hash_password(password)),
-            )
-            conn.commit()
-        return True
+        password_hash = hash_password(password)
+        with db_write() as conn:
+            # The username PRIMARY KEY resolves the conflict; no separate existence check
+            return conn.execute(SQL_INSERT_USER, (username, password_hash)).rowcount == 1
     except Exception:
         return False
 
@@ -85,14 +144,12 @@ def log_in(username: str, password: str) -> bool:
     if not username or not password:
         return False
     try:
-        with get_db() as conn:
-            cur = conn.cursor()
-            cur.execute("SELECT password_hash FROM users WHERE username=?", (username,))
-            row = cur.fetchone()
-            if not row:
-                return False
-            if verify_password(row[0], password):
-                return True
+        with get_db_lock():
+            row = get_db().execute(SQL_PASSWORD_HASH, (username,)).fetchone()
+        if not row:
+            return False
+        if verify_password(row[0], password):
+            return True
     except Exception:
         pass
     return False
@@ -101,100 +158,399 @@ def log_in(username: str, password: str) -> bool:
 # -------------------------
 # Utilities
 # -------------------------
-def extract_and_clean_chinese(url: str):
+AIHUBMIX_API_URL = "https://api.aihubmix.com/v1/chat/completions"
+HUNYUAN_API_URL = "https://api.hunyuan.cloud.tencent.com/v1/chat/completions"
+# These models reject max_tokens and take max_completion_tokens instead
+MODELS_NEED_MAX_COMPLETION = frozenset({"gpt-5", "gpt-5-mini", "o3", "o4-mini"})
+# Selectable models per provider, in display order
+AIHUBMIX_MODELS = (
+    # OpenAI
+    "gpt-5",
+    "gpt-5-mini",
+    "o3",
+    "o4-mini",
+    "gpt-4o",
+    "gpt-4-turbo",
+    "gpt-3.5-turbo",
+    # Qwen
+    "Qwen3-235B-A22B-Instruct-2507",
+    "Qwen/Qwen3-235B-A22B-Thinking-2507",
+    "Qwen/Qwen2.5-VL-72B-Instruct",
+    "Qwen3-Next-80B-A3B-Instruct",
+    # Moonshot
+    "moonshot-v1-32k",
+    "moonshot-v1-128k",
+    # Llama
+    "Llama-4-Maverick-17B-128E-Instruct-FP8",
+    "llama-3.3-70b-versatile",
+    "llama-3.1-8b-instant",
+    # Claude
+    "claude-3-haiku-20240307",
+    "claude-3-5-haiku-20241022",
+    "claude-3-7-sonnet-20250219",
+    "claude-opus-4-0",
+    "claude-opus-4-1",
+    # GLM
+    "glm-4",
+    "glm-4.5",
+    "THUDM/GLM-4.1V-9B-Thinking",
+    # Gemini
+    "gemini-2.0-flash",
+    "gemini-2.5-pro-preview-05-06",
+    "gemini-2.5-flash-lite-preview-06-17",
+    # Doubao
+    "doubao-seed-1-6-250615",
+    "doubao-seed-1-6-flash-250615",
+    "Doubao-1.5-thinking-pro",
+    "Doubao-1.5-pro-256k",
+    "Doubao-1.5-lite-32k",
+    # DeepSeek
+    "deepseek-r1-250528",
+    "deepseek-v3-250324",
+    "DeepSeek-V3.1-Fast",
+    "deepseek-ai/DeepSeek-V2.5",
+    # Kimi
+    "kimi-k2-0905-preview",
+    "kimi-k2-turbo-preview",
+    # Grok
+    "grok-4-fast-reasoning",
+    "grok-4",
+    "grok-3",
+    # Ernie
+    "ernie-4.5-turbo-vl-32k-preview",
+    "ernie-x1-turbo-32k-preview",
+    "ernie-x1.1-preview",
+    "baidu/ERNIE-4.5-300B-A47B",
+)
+HUNYUAN_MODELS = ("hunyuan-pro", "hunyuan-standard", "hunyuan-turbos-latest", "hunyuan-t1-latest")
+CENSOR_IMG_PATH = Path("D:/My/aihubmix/censorship.png").absolute()
+MAX_FETCHES_PER_HOST = 4
+MAX_HTML_BYTES = 512 * 1024  # decompressed HTML read per article
+MAX_RESPONSE_CHARS = 4000  # model answer kept per call, whatever the token limit
+
+_TITLE_RE = re.compile(r'【404文库】|【CDT.*?】|【\w+】')
+_JUNK_KEYWORDS = ('CDT 档案卡', '编者按', 'CDT编辑注', '相关阅读', '版权说明', '更多文章')
+# div/p/span nodes whose descendant text contains a junk keyword; only candidates, is_junk() makes the call
+_JUNK_XPATH = etree.XPath(
+    "descendant::*[self::div or self::p or self::span][{}]".format(
+        " or ".join(f"contains(., '{k}')" for k in _JUNK_KEYWORDS)
+    )
+)
+_IMG_RE = re.compile(r'img\s*\n*|\[.*?\]|更多文章')
+_CHARSET_RE = re.compile(r'charset=["\']?([\w.:-]+)', re.I)
+_META_CHARSET_RE = re.compile(rb'<meta[^>]*?charset=["\']?([\w.:-]+)', re.I)
+_KEEP_PUNCT = frozenset('.,!?()[]"《》')
+
+
+def _keep_rule(ch: str) -> bool:
+    # Same rule as the former [^\u4e00-\u9fff\w\s...] regex: \w is isalnum() or "_"
+    return '\u4e00' <= ch <= '\u9fff' or ch.isalnum() or ch == '_' or ch.isspace() or ch in _KEEP_PUNCT
+
+
+_ASCII_KEEP = bytes(_keep_rule(chr(i)) for i in range(128))
+
+
+@functools.lru_cache(maxsize=4096)
+def _is_kept_char(ch: str) -> bool:
+    o = ord(ch)
+    if o < 128:
+        return bool(_ASCII_KEEP[o])
+    return 0x4e00 <= o <= 0x9fff or _keep_rule(ch)
+
+
+def strip_disallowed_chars(text: str) -> str:
+    """Drop characters outside CJK, word chars, whitespace and basic punctuation"""
+    drop = {ord(ch): None for ch in set(text) if not _is_kept_char(ch)}
+    return text.translate(drop)
+
+
+# Pages labelled GB2312/GBK routinely use GB18030-only characters (e.g. 镕); browsers decode them as GB18030 too
+_CHARSET_SUPERSETS = {"gb2312": "gb18030", "gbk": "gb18030"}
+
+
+def _codec_name(name: str) -> Optional[str]:
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
-        response = session.get(url, headers=headers, timeout=(5, 20))
+        name = codecs.lookup(name).name
+    except LookupError:
+        return None
+    return _CHARSET_SUPERSETS.get(name, name)
+
+
+def declared_charset(content_type: str) -> Optional[str]:
+    """Charset named in a Content-Type header, or None"""
+    match = _CHARSET_RE.search(content_type)
+    return _codec_name(match.group(1)) if match else None
+
+
+def page_charset(content_type: str, head: bytes) -> str:
+    """Charset from the header, else from a <meta> tag in the first chunk, else UTF-8"""
+    charset = declared_charset(content_type)
+    if charset is None:
+        match = _META_CHARSET_RE.search(head)
+        charset = _codec_name(match.group(1).decode('ascii')) if match else None
+    return charset or "utf-8"
+
+
+def _sole_text(el) -> Optional[str]:
+    """bs4's `.string`: the text at the end of a chain of single-child elements, else None"""
+    while len(el):
+        if len(el) > 1 or el.text or el[0].tail:
+            return None
+        el = el[0]
+    return el.text
+
+
+def is_junk(el) -> bool:
+    text = _sole_text(el)
+    return text is not None and any(k in text for k in _JUNK_KEYWORDS)
+
+
+@st.cache_resource(show_spinner=False)
+def get_host_semaphore(host: str) -> threading.BoundedSemaphore:
+    # Keeps batch fetches polite: at most MAX_FETCHES_PER_HOST downloads per site at once
+    return threading.BoundedSemaphore(MAX_FETCHES_PER_HOST)
+
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=256)
+def fetch_article(url: str) -> tuple[str, str]:
+    """Fetch and clean one article; raises on failure so errors are never cached"""
+    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+    # Feed the parser while the body streams in, stopping at the cap; the text is truncated further down anyway.
+    # Bytes are decoded here, leniently: libxml2's own conversion aborts the parse on the first invalid byte.
+    total = 0
+    with get_host_semaphore(urlparse(url).netloc), session.get(url, headers=headers, timeout=(5, 20), stream=True) as response:
         response.raise_for_status()
-        soup = BeautifulSoup(response.content, 'html.parser')
-        title_elem = soup.find('h1') or soup.find('title')
-        title = title_elem.get_text().strip() if title_elem else "Unknown Title"
-        title = re.sub(r'【404文库】|【CDT.*?】|【\w+】', '', title).strip()
-        content_div = soup.find('div', class_='entry-content') or soup.find('article')
-        if not content_div:
-            content_div = soup
-        for elem in content_div.find_all(['div', 'p', 'span'], text=re.compile(r'CDT 档案卡|编者按|CDT编辑注|相关阅读|版权说明|更多文章')):
-            elem.decompose()
-        text_parts = [p.get_text().strip() for p in content_div.find_all(['p', 'h2', 'h3']) if len(p.get_text().strip()) > 20]
-        cleaned = '\n\n'.join(text_parts)
-        cleaned = re.sub(r'img\s*\n*|\[.*?\]|更多文章', '', cleaned)
-        cleaned = re.sub(r'[^\u4e00-\u9fff\w\s\.\,\!\?\(\)\[\]\"\"\《\》]', '', cleaned)
-        cleaned = re.sub(r'\s+', ' ', cleaned).strip()
-        if len(cleaned) > 5000:
-            cleaned = cleaned[:5000] + "..."
-        return title, cleaned
-    except Exception as e:
-        return "Error Title", f"网页抓取失败: {str(e)}"
+        chunks = response.iter_content(65536)
+        first = next(chunks, b"")
+        decoder = codecs.getincrementaldecoder(page_charset(response.headers.get("Content-Type", ""), first))(errors="replace")
+        parser = lxml_html.HTMLParser()
+        for chunk in itertools.chain((first,), chunks):
+            parser.feed(decoder.decode(chunk))
+            total += len(chunk)
+            if total > MAX_HTML_BYTES:
+                break
+        parser.feed(decoder.decode(b"", final=True))
+    tree = parser.close()
+    if tree is None:
+        raise ValueError("empty response body")
+    title_elem = tree.find('.//h1')
+    if title_elem is None:
+        title_elem = tree.find('.//title')
+    title = title_elem.text_content().strip() if title_elem is not None else "Unknown Title"
+    title = _TITLE_RE.sub('', title).strip()
+    content_div = next(iter(tree.xpath("//div[contains(concat(' ', normalize-space(@class), ' '), ' entry-content ')]")), None)
+    if content_div is None:
+        content_div = tree.find('.//article')
+    if content_div is None:
+        content_div = tree
+    # Script/style bodies would otherwise leak into text_content()
+    etree.strip_elements(content_div, 'script', 'style', 'noscript', with_tail=False)
+    for elem in _JUNK_XPATH(content_div):
+        if is_junk(elem):
+            elem.drop_tree()
+    raw_parts = (p.text_content().strip() for p in content_div.iterdescendants('p', 'h2', 'h3'))
+    text_parts = [t for t in raw_parts if len(t) > 20]
+    cleaned = '\n\n'.join(text_parts)
+    cleaned = _IMG_RE.sub('', cleaned)
+    cleaned = strip_disallowed_chars(cleaned)
+    cleaned = ' '.join(cleaned.split())
+    if len(cleaned) > 5000:
+        cleaned = cleaned[:5000] + "..."
+    return title, cleaned
+
+
+class RateLimiter:
+    """Per-provider pacing: a sliding-window RPM cap plus AIMD-adjusted concurrency"""
+
+    def __init__(self, rpm: int = 120, max_concurrency: int = 16, target_latency: float = 15.0):
+        self.rpm = rpm
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.concurrency = float(max_concurrency)
+        self._in_flight = 0
+        self._sent = deque()
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Block until a request slot is free under both the concurrency and RPM limits"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._sent and now - self._sent[0] >= 60:
+                    self._sent.popleft()
+                if self._in_flight < int(self.concurrency) and len(self._sent) < self.rpm:
+                    break
+                timeout = 60 - (now - self._sent[0]) if len(self._sent) >= self.rpm else None
+                self._cond.wait(timeout)
+            self._in_flight += 1
+            self._sent.append(now)
+
+    def release(self, resp: Optional[requests.Response], latency: float):
+        """Free the slot and adapt concurrency: +0.5 on a fast success, halve on throttling"""
+        throttled = (
+            resp is None
+            or resp.status_code == 429
+            or resp.status_code >= 500
+            or resp.headers.get("x-ratelimit-remaining-requests") == "0"
+        )
+        with self._cond:
+            self._in_flight -= 1
+            if throttled:
+                self.concurrency = max(1.0, self.concurrency * 0.5)
+            elif resp.ok and latency <= self.target_latency:
+                self.concurrency = min(float(self.max_concurrency), self.concurrency + 0.5)
+            self._cond.notify_all()
 
 
-def query_single_model(api_url: str, api_key: str, model: str, context: str, prompt: str, max_retries: int = 2):
-    """Query a single model with retry mechanism"""
-    messages = [{"role": "user", "content": f"文章内容：{context}\n\n指令：{prompt}"}]
+@st.cache_resource
+def get_rate_limiter(provider_name: str) -> RateLimiter:
+    return RateLimiter()
+
+
+def retry_after_seconds(resp: Optional[requests.Response]) -> float:
+    """Seconds requested by a Retry-After header (capped at 60), or 0"""
+    if resp is None:
+        return 0.0
+    try:
+        return min(60.0, max(0.0, float(resp.headers.get("retry-after", 0))))
+    except ValueError:
+        return 0.0
+
+
+def request_completion(api_url: str, api_key: str, model: str, messages: list[dict], max_retries: int = 3, limiter: Optional[RateLimiter] = None) -> str:
+    """POST one chat completion with retries; raises once retries are exhausted"""
     headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
     
-    # Special handling for different model types
-    models_need_max_completion = ["gpt-5", "gpt-5-mini", "o3", "o4-mini"]
     payload = {
         "model": model,
         "messages": messages,
         "temperature": 0.8,
     }
     
-    if model in models_need_max_completion:
+    if model in MODELS_NEED_MAX_COMPLETION:
         payload["max_completion_tokens"] = 800
     else:
         payload["max_tokens"] = 800
     
-    backoff = 2
+    # Encoded once to UTF-8 bytes and reused by every retry
+    body = orjson.dumps(payload)
+    
+    backoff = 1
     for retry in range(max_retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        start = time.perf_counter()
+        resp = None
         try:
-            start = time.perf_counter()
-            resp = session.post(api_url, headers=headers, json=payload, timeout=(5, 25))
+            resp = session.post(api_url, headers=headers, data=body, timeout=(5, 25))
             resp.raise_for_status()
-            data = resp.json()
+            data = orjson.loads(resp.content)
             
             if 'choices' in data and len(data['choices']) > 0:
-                content = data['choices'][0]['message']['content'].strip()
-            elif 'content' in data:
-                content = data['content'].strip()
-            else:
-                content = f"Error: Unexpected response format: {data}"
+                return data['choices'][0]['message']['content'].strip()[:MAX_RESPONSE_CHARS]
+            if 'content' in data:
+                return data['content'].strip()[:MAX_RESPONSE_CHARS]
+            raise ValueError(f"Unexpected response format: {data}")
             
-            elapsed = time.perf_counter() - start
-            return model, content
-            
-        except Exception as e:
-            if retry < max_retries:
-                time.sleep(backoff)
-                backoff *= 2
-            else:
-                return model, f"模型 {model} 调用失败: {str(e)}"
+        except Exception:
+            if retry == max_retries:
+                raise
+        finally:
+            if limiter is not None:
+                limiter.release(resp, time.perf_counter() - start)
+        time.sleep(max(backoff, retry_after_seconds(resp)))
+        backoff *= 2
 
 
-def call_provider_concurrent(api_url: str, api_key: str, models: list[str], context: str, prompt: str, provider_name: str):
-    """Call multiple models concurrently for a single prompt"""
-    results = OrderedDict((m, "未响应") for m in models)
-    
-    max_workers = min(8, len(models))  # Limit concurrent requests
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {
-            executor.submit(query_single_model, api_url, api_key, m, context, prompt): m 
-            for m in models
-        }
-        
-        for future in as_completed(futures):
-            model, response = future.result()
-            results[model] = response
-    
-    return results
+@st.cache_data(ttl=86400, show_spinner=False, max_entries=2048)
+def cached_completion(api_url: str, api_key_digest: str, model: str, messages_digest: str, _api_key: str, _messages: list[dict], _limiter: Optional[RateLimiter]) -> str:
+    """Completion cached on the digests only; underscore args are left out of the cache key"""
+    return request_completion(api_url, _api_key, model, _messages, limiter=_limiter)
+
+
+def query_single_model(api_url: str, api_key: str, model: str, context: str, prompt: str, limiter: Optional[RateLimiter] = None):
+    """Query a single model, reusing the cached answer for an identical request"""
+    messages = [{"role": "user", "content": f"文章内容：{context}\n\n指令：{prompt}"}]
+    messages_json = orjson.dumps(messages, option=orjson.OPT_SORT_KEYS)
+    try:
+        content = cached_completion(
+            api_url,
+            hashlib.sha256(api_key.encode("utf-8")).hexdigest(),
+            model,
+            hashlib.sha256(messages_json).hexdigest(),
+            api_key,
+            messages,
+            limiter,
+        )
+        return model, content
+    except Exception as e:
+        return model, f"模型 {model} 调用失败: {str(e)}"
+
+
+def submit_provider_calls(executor: ThreadPoolExecutor, provider: dict, context: str, prompts: list[str], submitted: dict) -> dict[tuple[int, str], Future]:
+    """Queue every (prompt, model) call for one provider, keyed by (1-based prompt index, model)
+
+    Identical calls already in `submitted` reuse that future instead of being queued twice.
+    """
+    limiter = get_rate_limiter(provider["name"])
+    futures = {}
+    for pidx, prompt in enumerate(prompts, start=1):
+        for m in provider["models"]:
+            key = (provider["url"], m, context, prompt)
+            if key not in submitted:
+                submitted[key] = executor.submit(query_single_model, provider["url"], provider["key"], m, context, prompt, limiter=limiter)
+            futures[(pidx, m)] = submitted[key]
+    return futures
+
+
+def emit_provider_block(provider: dict, prompts: list[str], futures: Optional[dict[tuple[int, str], Future]], w: Callable[[str], int]) -> None:
+    """Write one provider's markdown section from its queued calls; futures is None when the key is missing"""
+    name, models = provider["name"], provider["models"]
+    if not models:
+        return
+    w(f"## Provider: {name}\n")
+    w("\n")
+    if futures is None:
+        w("(skipped: missing key)\n")
+        w("\n")
+        return
+    for pidx, prompt in enumerate(prompts, start=1):
+        w(f"### 提示语 {pidx}: {prompt}\n")
+        w("\n")
+        for m in models:
+            _, r = futures[(pidx, m)].result()
+            w(f"#### 模型: {m}\n")
+            w("\n")
+            w(f"{r}\n")
+            w("\n")
+            w("---\n")
+            w("\n")
+
+
+_FILENAME_TABLE = str.maketrans("", "", '\\/:*?"<>|')
+
+
+def sanitize_filename(s: str) -> str:
+    # split() also drops Unicode whitespace such as the ideographic space
+    s = "".join(s.translate(_FILENAME_TABLE).split())
+    return s[:100]  # Limit filename length
+
+
+ZIP_STORE_THRESHOLD = 1_000_000  # characters of report text
 
 
 def create_zip_from_files(files: list[tuple[str, str]]) -> bytes:
     """Create a ZIP file in memory from a list of (filename, content) tuples."""
     zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+    # Small archives are stored as-is; larger ones use fast level-1 DEFLATE
+    if sum(len(content) for _, content in files) < ZIP_STORE_THRESHOLD:
+        options = {"compression": zipfile.ZIP_STORED}
+    else:
+        options = {"compression": zipfile.ZIP_DEFLATED, "compresslevel": 1}
+    with zipfile.ZipFile(zip_buffer, 'w', **options) as zip_file:
         for fname, content in files:
-            zip_file.writestr(fname, content.encode('utf-8'))
+            # writestr encodes str as UTF-8 itself
+            zip_file.writestr(fname, content)
     return zip_buffer.getvalue()
 
 
@@ -203,8 +559,7 @@ def create_zip_from_files(files: list[tuple[str, str]]) -> bytes:
 # -------------------------
 st.set_page_config(page_title="Censorship Compare", layout="wide")
 
-# Initialize database
-init_db()
+PREVIEW_PAGE_SIZE = 10  # file previews rendered before "Show all"
 
 # Initialize session state
 if "auth_user" not in st.session_state:
@@ -213,6 +568,10 @@ if "generated_files" not in st.session_state:
     st.session_state.generated_files = []
 if "show_results" not in st.session_state:
     st.session_state.show_results = False
+if "show_all_previews" not in st.session_state:
+    st.session_state.show_all_previews = False
+if "zip_data" not in st.session_state:
+    st.session_state.zip_data = None
 
 st.title("Censorship Compare - AiHubMix & Hunyuan")
 
@@ -228,6 +587,8 @@ if st.session_state.auth_user:
             st.session_state.auth_user = None
             st.session_state.generated_files = []
             st.session_state.show_results = False
+            st.session_state.show_all_previews = False
+            st.session_state.zip_data = None
             st.rerun()
 else:
     col1, col2 = st.columns(2)
@@ -262,6 +623,12 @@ if not st.session_state.auth_user:
 # -------------------------
 # Main Application
 # -------------------------
+with st.sidebar:
+    # Cached article fetches (1h) and LLM answers (1 day) are shared across sessions
+    if st.button("Clear cache", key="clear_cache_btn", help="Re-fetch articles and re-query models on the next run"):
+        st.cache_data.clear()
+        st.success("✓ Cache cleared")
+
 st.header("Inputs")
 col_left, col_right = st.columns(2)
 
@@ -272,74 +639,20 @@ with col_left:
 with col_right:
     st.markdown("**AiHubMix**")
     aihubmix_key = st.text_input("AIHUBMIX_API_KEY", type="password", key="aihubmix_key")
-    aihubmix_models_all = [
-        # OpenAI
-        "gpt-5",
-        "gpt-5-mini",
-        "o3",
-        "o4-mini",
-        "gpt-4o",
-        "gpt-4-turbo",
-        "gpt-3.5-turbo",
-        # Qwen
-        "Qwen3-235B-A22B-Instruct-2507",
-        "Qwen/Qwen3-235B-A22B-Thinking-2507",
-        "Qwen/Qwen2.5-VL-72B-Instruct",
-        "Qwen3-Next-80B-A3B-Instruct",
-        # Moonshot
-        "moonshot-v1-32k",
-        "moonshot-v1-128k",
-        # Llama
-        "Llama-4-Maverick-17B-128E-Instruct-FP8",
-        "llama-3.3-70b-versatile",
-        "llama-3.1-8b-instant",
-        # Claude
-        "claude-3-haiku-20240307",
-        "claude-3-5-haiku-20241022",
-        "claude-3-7-sonnet-20250219",
-        "claude-opus-4-0",
-        "claude-opus-4-1",
-        # GLM
-        "glm-4",
-        "glm-4.5",
-        "THUDM/GLM-4.1V-9B-Thinking",
-        # Gemini
-        "gemini-2.0-flash",
-        "gemini-2.5-pro-preview-05-06",
-        "gemini-2.5-flash-lite-preview-06-17",
-        # Doubao
-        "doubao-seed-1-6-250615",
-        "doubao-seed-1-6-flash-250615",
-        "Doubao-1.5-thinking-pro",
-        "Doubao-1.5-pro-256k",
-        "Doubao-1.5-lite-32k",
-        # DeepSeek
-        "deepseek-r1-250528",
-        "deepseek-v3-250324",
-        "DeepSeek-V3.1-Fast",
-        "deepseek-ai/DeepSeek-V2.5",
-        # Kimi
-        "kimi-k2-0905-preview",
-        "kimi-k2-turbo-preview",
-        # Grok
-        "grok-4-fast-reasoning",
-        "grok-4",
-        "grok-3",
-        # Ernie
-        "ernie-4.5-turbo-vl-32k-preview",
-        "ernie-x1-turbo-32k-preview",
-        "ernie-x1.1-preview",
-        "baidu/ERNIE-4.5-300B-A47B"
-    ]
-    aihubmix_models = st.multiselect("Select AiHubMix models", aihubmix_models_all, default=aihubmix_models_all[:2], key="aihubmix_models")
+    aihubmix_models = st.multiselect("Select AiHubMix models", AIHUBMIX_MODELS, default=AIHUBMIX_MODELS[:2], key="aihubmix_models")
 
     st.markdown("**Hunyuan (Cherry-Studio)**")
     hunyuan_key = st.text_input("CHERRY_API_KEY", type="password", key="hunyuan_key")
-    hunyuan_models_all = ["hunyuan-pro", "hunyuan-standard", "hunyuan-turbos-latest", "hunyuan-t1-latest"]
-    hunyuan_models = st.multiselect("Select Hunyuan models", hunyuan_models_all, default=hunyuan_models_all[:2], key="hunyuan_models")
+    hunyuan_models = st.multiselect("Select Hunyuan models", HUNYUAN_MODELS, default=HUNYUAN_MODELS[:2], key="hunyuan_models")
+
+providers = [
+    {"name": "aihubmix", "url": AIHUBMIX_API_URL, "key": aihubmix_key, "models": aihubmix_models},
+    {"name": "hunyuan", "url": HUNYUAN_API_URL, "key": hunyuan_key, "models": hunyuan_models},
+]
 
 if st.button("Run Analysis", key="run_btn"):
-    urls = [u.strip() for u in urls_text.splitlines() if u.strip()]
+    # Duplicate URLs would repeat the whole model fan-out for an identical report
+    urls = list(dict.fromkeys(u.strip() for u in urls_text.splitlines() if u.strip()))
     prompts = [p.strip() for p in prompts_text.splitlines() if p.strip()]
     
     if not urls or not prompts:
@@ -347,148 +660,101 @@ if st.button("Run Analysis", key="run_btn"):
     else:
         st.session_state.generated_files = []
         st.session_state.show_results = False
+        st.session_state.show_all_previews = False
+        st.session_state.zip_data = None
         
         progress_bar = st.progress(0)
         status_text = st.empty()
         total_steps = len(urls)
-        
-        for idx, url in enumerate(urls):
-            status_text.text(f"Processing URL {idx+1}/{total_steps}: {url[:50]}...")
-            progress_bar.progress((idx) / total_steps)
-            
-            try:
-                title, cleaned = extract_and_clean_chinese(url)
-            except Exception as e:
-                st.error(f"✗ Fetch failed for {url}: {e}")
-                continue
+
+        # Loop-invariant: one timestamp for every file in the run, and one banner image check
+        run_ts = datetime.now()
+        ts_compact = run_ts.strftime('%Y%m%d_%H%M%S')
+        ts_display = run_ts.strftime('%Y-%m-%d %H:%M')
+        censor_img_md = f"![审查提示图]({CENSOR_IMG_PATH})\n" if CENSOR_IMG_PATH.exists() else ""
+
+        # One pool for the whole run: article fetches first, then every provider's LLM calls
+        # Workers carry this run's script context so the cached fetch/LLM calls see the session
+        with ThreadPoolExecutor(max_workers=24, initializer=functools.partial(add_script_run_ctx, ctx=get_script_run_ctx())) as executor:
+            # Fetch all articles up front; the LLM stage below only waits on results
+            status_text.text(f"Fetching {total_steps} URL(s)...")
+            # Unreachable URLs fail here and are skipped before any model is queried for them
+            fetch_futures = {u: executor.submit(fetch_article, u) for u in urls}
+            # (provider url, model, context, prompt) -> Future, shared by every test in the run
+            submitted_calls = {}
+
+            for idx, url in enumerate(urls):
+                status_text.text(f"Processing URL {idx+1}/{total_steps}: {url[:50]}...")
+                progress_bar.progress((idx) / total_steps)
+
+                try:
+                    title, cleaned = fetch_futures[url].result()
+                except Exception as e:
+                    st.error(f"✗ Fetch failed for {url}: {e}")
+                    continue
             
-            try:
-                netloc = urlparse(url).netloc
-                source = netloc.replace("www.", "").split(":")[0]
-            except Exception:
-                source = "来源"
-
-            def sanitize_filename(s: str) -> str:
-                s = re.sub(r"[\\/:*?\"<>|]", "", s)
-                s = re.sub(r"\s+", "", s)
-                return s[:100]  # Limit filename length
-
-            ts = datetime.now().strftime('%Y%m%d_%H%M%S')
-
-            provider_names = []
-            if aihubmix_models:
-                provider_names.append("aihubmix")
-            if hunyuan_models:
-                provider_names.append("hunyuan")
-            providers_line = ", ".join(provider_names) if provider_names else "(none)"
-
-            called_models_lines = []
-            aihubmix_list = ", ".join(aihubmix_models) if aihubmix_models else "(none)"
-            hunyuan_list = ", ".join(hunyuan_models) if hunyuan_models else "(none)"
-            called_models_lines.append(f"- aihubmix: {aihubmix_list}")
-            called_models_lines.append(f"- hunyuan: {hunyuan_list}")
-
-            tests = [
-                ("A", title, cleaned, False),
-                ("B", f"{title}_此内容因违规无法查看", cleaned, True),
-            ]
-
-            for test_type, test_title, test_context, is_b in tests:
-                blocks: list[str] = []
-                content_title = f"{source}｜{title}"
-                if is_b:
-                    content_title = content_title + "_此内容因违规无法查看"
-                blocks.append(f"# {content_title}")
-
-                blocks.append("")
-                blocks.append("**Providers:**")
-                blocks.append(providers_line)
-                blocks.append("")
-                blocks.append("**Called Models:**")
-                blocks.extend(called_models_lines)
-                blocks.append("")
-                blocks.append(f"处理日期: {datetime.now().strftime('%Y-%m-%d %H:%M')}")
-                blocks.append("")
-
-                if is_b:
-                    img_path = Path("D:/My/aihubmix/censorship.png").absolute()
-                    if img_path.exists():
-                        blocks.append(f"![审查提示图]({img_path})")
-                    blocks.append("")
-                    blocks.append("**此文章因违规已经无法查看，以下内容为屏蔽前手动保存**")
-                    blocks.append("")
-                    blocks.append("---")
-                    blocks.append("")
-
-                blocks.append("## 审查比较分析")
-                blocks.append("- 提示语 1: 判断是否应该删除屏蔽")
-                blocks.append("- 提示语 2: 判断已被删除屏蔽的可能性")
-                blocks.append("")
-
-                if aihubmix_key and aihubmix_models:
-                    blocks.append("## Provider: aihubmix")
-                    blocks.append("")
-                    for pidx, prompt in enumerate(prompts, start=1):
-                        blocks.append(f"### 提示语 {pidx}: {prompt}")
-                        blocks.append("")
-                        aihubmix_res = call_provider_concurrent(
-                            api_url="https://api.aihubmix.com/v1/chat/completions",
-                            api_key=aihubmix_key,
-                            models=aihubmix_models,
-                            context=test_context,
-                            prompt=prompt,
-                            provider_name="aihubmix",
-                        )
-                        for m in aihubmix_models:
-                            r = aihubmix_res.get(m, "")
-                            blocks.append(f"#### 模型: {m}")
-                            blocks.append("")
-                            blocks.append(r)
-                            blocks.append("")
-                            blocks.append("---")
-                            blocks.append("")
-                        # Small delay between prompts
-                        time.sleep(1)
-                elif aihubmix_models:
-                    blocks.append("## Provider: aihubmix")
-                    blocks.append("")
-                    blocks.append("(skipped: missing key)")
-                    blocks.append("")
-
-                if hunyuan_key and hunyuan_models:
-                    blocks.append("## Provider: hunyuan")
-                    blocks.append("")
-                    for pidx, prompt in enumerate(prompts, start=1):
-                        blocks.append(f"### 提示语 {pidx}: {prompt}")
-                        blocks.append("")
-                        hunyuan_res = call_provider_concurrent(
-                            api_url="https://api.hunyuan.cloud.tencent.com/v1/chat/completions",
-                            api_key=hunyuan_key,
-                            models=hunyuan_models,
-                            context=test_context,
-                            prompt=prompt,
-                            provider_name="hunyuan",
-                        )
-                        for m in hunyuan_models:
-                            r = hunyuan_res.get(m, "")
-                            blocks.append(f"#### 模型: {m}")
-                            blocks.append("")
-                            blocks.append(r)
-                            blocks.append("")
-                            blocks.append("---")
-                            blocks.append("")
-                        # Small delay between prompts
-                        time.sleep(1)
-                elif hunyuan_models:
-                    blocks.append("## Provider: hunyuan")
-                    blocks.append("")
-                    blocks.append("(skipped: missing key)")
-                    blocks.append("")
-
-                safe_title = sanitize_filename(f"{source}{title}")
-                fname = f"{safe_title}_{test_type}_{ts}.md"
-                content = "\n".join(blocks)
-                st.session_state.generated_files.append((fname, content))
+                try:
+                    netloc = urlparse(url).netloc
+                    source = netloc.replace("www.", "").split(":")[0]
+                except Exception:
+                    source = "来源"
+
+                providers_line = ", ".join(p["name"] for p in providers if p["models"]) or "(none)"
+                called_models_block = "".join(f"- {p['name']}: {', '.join(p['models']) or '(none)'}\n" for p in providers)
+
+                tests = [
+                    ("A", title, cleaned, False),
+                    ("B", f"{title}_此内容因违规无法查看", cleaned, True),
+                ]
+
+                # Queue the whole test x provider x prompt x model grid before writing anything,
+                # so every call for this article runs in one wave
+                test_futures = [
+                    [
+                        submit_provider_calls(executor, p, test_context, prompts, submitted_calls) if p["key"] else None
+                        for p in providers
+                    ]
+                    for _, _, test_context, _ in tests
+                ]
+
+                for (test_type, test_title, test_context, is_b), provider_futures in zip(tests, test_futures):
+                    buf = io.StringIO()
+                    w = buf.write
+                    content_title = f"{source}｜{title}"
+                    if is_b:
+                        content_title = content_title + "_此内容因违规无法查看"
+                    w(f"# {content_title}\n")
+
+                    w("\n")
+                    w("**Providers:**\n")
+                    w(f"{providers_line}\n")
+                    w("\n")
+                    w("**Called Models:**\n")
+                    w(called_models_block)
+                    w("\n")
+                    w(f"处理日期: {ts_display}\n")
+                    w("\n")
+
+                    if is_b:
+                        w(censor_img_md)
+                        w("\n")
+                        w("**此文章因违规已经无法查看，以下内容为屏蔽前手动保存**\n")
+                        w("\n")
+                        w("---\n")
+                        w("\n")
+
+                    w("## 审查比较分析\n")
+                    w("- 提示语 1: 判断是否应该删除屏蔽\n")
+                    w("- 提示语 2: 判断已被删除屏蔽的可能性\n")
+                    w("\n")
+
+                    for provider, futures in zip(providers, provider_futures):
+                        emit_provider_block(provider, prompts, futures, w)
+
+                    safe_title = sanitize_filename(f"{source}{title}")
+                    fname = f"{safe_title}_{test_type}_{ts_compact}.md"
+                    content = buf.getvalue()
+                    st.session_state.generated_files.append((fname, content))
         
         progress_bar.progress(1.0)
         status_text.text("✓ Analysis complete!")
@@ -502,12 +768,14 @@ if st.session_state.show_results and st.session_state.generated_files:
     st.header("Results")
     
     # Create ZIP download button
-    zip_data = create_zip_from_files(st.session_state.generated_files)
+    # Build the archive once per run; reruns (download clicks, "Show all") reuse it
+    if st.session_state.zip_data is None:
+        st.session_state.zip_data = create_zip_from_files(st.session_state.generated_files)
     ts_zip = datetime.now().strftime('%Y%m%d_%H%M%S')
     
     st.download_button(
         label=f"📦 Download All Results as ZIP ({len(st.session_state.generated_files)} files)",
-        data=zip_data,
+        data=st.session_state.zip_data,
         file_name=f"censorship_analysis_{ts_zip}.zip",
         mime="application/zip",
         key="download_zip",
@@ -516,8 +784,18 @@ if st.session_state.show_results and st.session_state.generated_files:
     
     st.divider()
     
-    # Display preview in expanders
+    # Display preview in expanders, one page at a time unless the user asks for all
     st.subheader("Preview Generated Files")
-    for fname, content in st.session_state.generated_files:
+    all_files = st.session_state.generated_files
+    shown_files = all_files if st.session_state.show_all_previews else all_files[:PREVIEW_PAGE_SIZE]
+    previews = [
+        (fname, content[:2000] + "\n\n... (truncated for display)" if len(content) > 2000 else content)
+        for fname, content in shown_files
+    ]
+    for fname, preview in previews:
         with st.expander(f"📄 {fname}"):
-            st.code(content[:2000] + "\n\n... (truncated for display)" if len(content) > 2000 else content, language="markdown")
\ No newline at end of file
+            st.code(preview, language="markdown")
+    if len(shown_files) < len(all_files):
+        if st.button(f"Show all {len(all_files)} files", key="show_all_previews_btn"):
+            st.session_state.show_all_previews = True
+            st.rerun()
\ No newline at end of file